@@ -1,18 +1,23 @@
 import os
+import functools
+import hmac
 import json
+import orjson
 import fastapi
 import uvicorn
 import psutil
+import numpy as np
 import asyncio
+import contextlib
 import time
 import socket
 import threading
 import logging
-from collections import deque
-from typing import Deque, Dict, Any
+from typing import Dict, Any, BinaryIO, Optional, Tuple
 from pathlib import Path
 from datetime import datetime
 from fastapi import Depends, HTTPException, status
+from fastapi.responses import Response
 from fastapi.security import APIKeyHeader
 
 # --- IMPROVEMENT: Basic logging configuration ---
@@ -24,7 +29,13 @@ logging.basicConfig(
 SAMPLE_INTERVAL_SECONDS = 5
 MAX_SAMPLES = (12 * 60 * 60) // SAMPLE_INTERVAL_SECONDS
 PERSISTENCE_FILE = Path("monthly_traffic.json")
+PROC_NET_DEV = Path("/proc/net/dev")
 SAVE_INTERVAL_MINUTES = 5
+POWER_LABELS = ("", "K", "M", "G", "T")
+COUNTER_WRAP_32 = 1 << 32
+# Bytes a 1 Gbps link, the fastest class still seen with 32-bit counters, can
+# move in one sample interval; larger "wrapped" deltas are treated as resets.
+MAX_WRAP_DELTA_BYTES = 1_000_000_000 // 8 * SAMPLE_INTERVAL_SECONDS
 
 # API Key Setup
 API_KEY = os.getenv("BANDWIDTH_API_KEY", "insecure-default-key-change-me")
@@ -32,12 +43,14 @@ if API_KEY == "insecure-default-key-change-me":
     logging.warning(
         "You are using a default, insecure API key. Please set BANDWIDTH_API_KEY."
     )
+API_KEY_BYTES = API_KEY.encode()
 
 api_key_header_scheme = APIKeyHeader(name="X-API-Key")
 
 
 async def get_api_key(api_key: str = Depends(api_key_header_scheme)):
-    if api_key != API_KEY:
+    # Compare as bytes: compare_digest rejects non-ASCII str with a TypeError.
+    if not hmac.compare_digest(api_key.encode(), API_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or Missing API Key",
@@ -45,6 +58,7 @@ async def get_api_key(api_key: str = Depends(api_key_header_scheme)):
 
 
 # Helper Functions
+@functools.lru_cache(maxsize=1)
 def get_default_interface_name() -> str:
     logging.info(
         "Attempting to automatically determine the default network interface..."
@@ -63,34 +77,148 @@ def get_default_interface_name() -> str:
                         f"✅ Successfully determined default network interface: '{interface_name}'"
                     )
                     return interface_name
+        logging.warning(
+            f"No interface owns the routed address {local_ip_address}, picking the fastest one that is up."
+        )
     except Exception as e:
         logging.warning(
-            f"Could not determine default interface, falling back to 'eth0'. Error: {e}"
+            f"Could not probe the default route, picking the fastest interface that is up. Error: {e}"
         )
+    return get_fastest_up_interface_name()
+
+
+def get_fastest_up_interface_name() -> str:
+    try:
+        stats = psutil.net_if_stats()
+    except Exception as e:
+        logging.warning(
+            f"Could not list interface stats, falling back to 'eth0'. Error: {e}"
+        )
+        return "eth0"
+    candidates = sorted(
+        (
+            (name, if_stats.speed)
+            for name, if_stats in stats.items()
+            if if_stats.isup and not name.startswith("lo")
+        ),
+        key=lambda candidate: -candidate[1],
+    )
+    if not candidates:
+        logging.warning("No usable interface is up, falling back to 'eth0'.")
         return "eth0"
+    logging.info(f"✅ Selected network interface by link speed: '{candidates[0][0]}'")
+    return candidates[0][0]
+
+
+def counter_delta(current: int, last: int) -> int:
+    """Returns the bytes counted between two reads of an interface counter."""
+    delta = current - last
+    if delta >= 0:
+        return delta
+    # /proc/net/dev counters are 64-bit and psutil already corrects wraps, so
+    # a drop almost always means the interface was reset or re-created (VPN
+    # or PPP reconnect); everything counted since then is new traffic.
+    wrapped = delta + COUNTER_WRAP_32
+    if last < COUNTER_WRAP_32 and wrapped <= MAX_WRAP_DELTA_BYTES:
+        # Only a reading just below 4 GiB followed by a small one looks like a
+        # genuine 32-bit wrap, as some embedded drivers still report.
+        return wrapped
+    return current
+
+
+def compute_next_month_epoch() -> float:
+    """Returns the Unix time at which the next calendar month (local time) begins."""
+    now = datetime.now()
+    if now.month == 12:
+        next_month = datetime(now.year + 1, 1, 1)
+    else:
+        next_month = datetime(now.year, now.month + 1, 1)
+    return next_month.timestamp()
 
 
 def format_bytes(byte_count: int) -> str:
     if byte_count is None:
         return "0 B"
-    power = 1024
-    n = 0
-    power_labels = {0: "", 1: "K", 2: "M", 3: "G", 4: "T"}
-    while byte_count >= power and n < len(power_labels) - 1:
-        byte_count /= power
-        n += 1
-    return f"{byte_count:.2f} {power_labels[n]}B"
+    # Each power of 1024 spans 10 bits, so the unit index falls straight out
+    # of the bit length instead of a repeated-division loop.
+    n = min(max(byte_count.bit_length() - 1, 0) // 10, len(POWER_LABELS) - 1)
+    return f"{byte_count / (1 << (n * 10)):.2f} {POWER_LABELS[n]}B"
+
+
+def render_bandwidth_stats(
+    total_sent: float, total_recv: float, current_count: int
+) -> bytes:
+    """Refreshes the shared stats template in place and returns it as JSON."""
+    # Only the sampler calls this, once per tick, so the 2-decimal rounding of
+    # the wire format is paid per sample rather than per request.
+    if not current_count:
+        avg_sent, avg_recv = 0.0, 0.0
+    else:
+        avg_sent = total_sent / current_count
+        avg_recv = total_recv / current_count
+    speeds = bandwidth_stats_template["average_speed_mbps"]
+    speeds["sent"] = round(avg_sent, 2)
+    speeds["received"] = round(avg_recv, 2)
+    speeds["total"] = round(avg_sent + avg_recv, 2)
+    bandwidth_stats_template["current_sample_count"] = current_count
+    return orjson.dumps(bandwidth_stats_template)
 
 
 # Global State
 NETWORK_INTERFACE = get_default_interface_name()
-sent_samples: Deque[float] = deque()
-recv_samples: Deque[float] = deque()
+# One row per sample: column 0 is sent Mbps, column 1 received Mbps.
+speed_ring = np.zeros((MAX_SAMPLES, 2), dtype=np.float64)
+write_idx: int = 0
+sample_count: int = 0
 running_total_sent: float = 0.0
 running_total_recv: float = 0.0
-monthly_traffic_state: Dict[str, Any] = {}
-GLOBAL_LOCK = threading.Lock()
-app = fastapi.FastAPI()
+# (month, total_bytes_sent, total_bytes_recv)
+monthly_traffic_state: Tuple[str, int, int] = ("", 0, 0)
+# Only the sampler thread mutates this; readers only ever see the bytes
+# serialized from it, so in-place updates are never observed half-done.
+bandwidth_stats_template: Dict[str, Any] = {
+    "network_interface": NETWORK_INTERFACE,
+    "average_speed_mbps": {"sent": 0.0, "received": 0.0, "total": 0.0},
+    "period_seconds": MAX_SAMPLES * SAMPLE_INTERVAL_SECONDS,
+    "current_sample_count": 0,
+    "max_samples_for_avg": MAX_SAMPLES,
+}
+# Serialized /stats/bandwidth body, rebuilt and republished as a whole by the
+# sampler each tick; the response can only change once per sample.
+cached_stats_body: bytes = render_bandwidth_stats(0.0, 0.0, 0)
+next_month_epoch: float = compute_next_month_epoch()
+PERSISTENCE_LOCK = threading.Lock()
+IFACE_PREFIX = f"{NETWORK_INTERFACE}:".encode()
+
+
+# Counter Readers
+def open_proc_net_dev() -> Optional[BinaryIO]:
+    """Opens /proc/net/dev for repeated reads, or returns None on non-Linux."""
+    try:
+        return open(PROC_NET_DEV, "rb")
+    except OSError:
+        logging.info("/proc/net/dev is unavailable, using psutil for stats.")
+        return None
+
+
+def read_interface_counters(proc_file: Optional[BinaryIO]) -> Tuple[int, int]:
+    """Returns (bytes_sent, bytes_recv) for NETWORK_INTERFACE."""
+    if proc_file is not None:
+        proc_file.seek(0)
+        for line in proc_file.read().splitlines():
+            line = line.lstrip()
+            if line.startswith(IFACE_PREFIX):
+                # rx_bytes is field 0 and tx_bytes field 8; leave the tail of
+                # the line unsplit instead of building all 16 fields.
+                fields = line[len(IFACE_PREFIX) :].split(None, 9)
+                return int(fields[8]), int(fields[0])
+    try:
+        net_io = psutil.net_io_counters(pernic=True)[NETWORK_INTERFACE]
+    except KeyError:
+        # Only build the system-wide aggregate when the interface is missing,
+        # rather than eagerly as a .get() default on every call.
+        net_io = psutil.net_io_counters()
+    return net_io.bytes_sent, net_io.bytes_recv
 
 
 # Persistence Functions
@@ -102,7 +230,11 @@ def load_monthly_traffic():
             with open(PERSISTENCE_FILE, "r") as f:
                 data = json.load(f)
             if data.get("month") == current_month:
-                monthly_traffic_state = data
+                monthly_traffic_state = (
+                    current_month,
+                    data.get("total_bytes_sent", 0),
+                    data.get("total_bytes_recv", 0),
+                )
                 logging.info(f"✅ Loaded traffic data for month {current_month}.")
                 return
         except (json.JSONDecodeError, IOError) as e:
@@ -111,136 +243,174 @@ def load_monthly_traffic():
             )
 
     logging.info(f"✨ Initializing new traffic log for month {current_month}.")
-    monthly_traffic_state = {
-        "month": current_month,
-        "total_bytes_sent": 0,
-        "total_bytes_recv": 0,
+    monthly_traffic_state = (current_month, 0, 0)
+
+
+def write_persistence_file(buf: bytes):
+    # Write and fsync a sibling temp file, then rename it over the target, so
+    # neither a crash nor a power loss mid-write leaves a truncated
+    # persistence file behind. The lock keeps a cancelled periodic save and
+    # the shutdown flush off the same temp file.
+    with PERSISTENCE_LOCK:
+        tmp = PERSISTENCE_FILE.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, PERSISTENCE_FILE)
+
+
+async def save_monthly_traffic():
+    month, sent, recv = monthly_traffic_state
+    state_to_save = {
+        "month": month,
+        "total_bytes_sent": sent,
+        "total_bytes_recv": recv,
     }
+    try:
+        buf = orjson.dumps(state_to_save, option=orjson.OPT_INDENT_2)
+        await asyncio.to_thread(write_persistence_file, buf)
+        logging.info("💾 Persisted monthly traffic data.")
+    except IOError as e:
+        logging.error(f"❌ Error saving persistence file: {e}")
 
 
 async def save_monthly_traffic_periodically():
     while True:
         await asyncio.sleep(SAVE_INTERVAL_MINUTES * 60)
-        with GLOBAL_LOCK:
-            state_to_save = monthly_traffic_state.copy()
-        try:
-            with open(PERSISTENCE_FILE, "w") as f:
-                json.dump(state_to_save, f, indent=4)
-            logging.info("💾 Persisted monthly traffic data.")
-        except IOError as e:
-            logging.error(f"❌ Error saving persistence file: {e}")
+        await save_monthly_traffic()
 
 
 # Background Tasks
-async def monitor_bandwidth():
+def monitor_bandwidth(shutdown: threading.Event):
     global running_total_sent, running_total_recv, monthly_traffic_state
+    global write_idx, sample_count, cached_stats_body, next_month_epoch
+    proc_file = open_proc_net_dev()
     try:
-        net_io_initial = psutil.net_io_counters(pernic=True).get(
-            NETWORK_INTERFACE, psutil.net_io_counters()
-        )
-        last_bytes_sent = net_io_initial.bytes_sent
-        last_bytes_recv = net_io_initial.bytes_recv
+        last_bytes_sent, last_bytes_recv = read_interface_counters(proc_file)
     except Exception as e:
         logging.error(
             f"❌ FATAL: Could not get initial network stats. Monitoring task will not run. Error: {e}"
         )
+        if proc_file is not None:
+            proc_file.close()
         return
 
-    last_check_time = time.time()
-    while True:
-        await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
-        current_time = time.time()
-        time_delta = current_time - last_check_time
+    last_check_ns = time.monotonic_ns()
+    # Runs on its own daemon thread so wakeups are scheduled by the OS rather
+    # than by however busy the event loop happens to be.
+    while not shutdown.wait(SAMPLE_INTERVAL_SECONDS):
+        current_ns = time.monotonic_ns()
+        time_delta_ns = current_ns - last_check_ns
         try:
-            net_io = psutil.net_io_counters(pernic=True).get(
-                NETWORK_INTERFACE, psutil.net_io_counters()
-            )
-            bytes_sent_delta = net_io.bytes_sent - last_bytes_sent
-            bytes_recv_delta = net_io.bytes_recv - last_bytes_recv
-            if time_delta > 0:
-                speed_sent_mbps = (bytes_sent_delta * 8) / 1_000_000 / time_delta
-                speed_recv_mbps = (bytes_recv_delta * 8) / 1_000_000 / time_delta
-                with GLOBAL_LOCK:
-                    sent_samples.append(speed_sent_mbps)
-                    running_total_sent += speed_sent_mbps
-                    if len(sent_samples) > MAX_SAMPLES:
-                        running_total_sent -= sent_samples.popleft()
-
-                    recv_samples.append(speed_recv_mbps)
-                    running_total_recv += speed_recv_mbps
-                    if len(recv_samples) > MAX_SAMPLES:
-                        running_total_recv -= recv_samples.popleft()
-
-                    current_month = datetime.now().strftime("%Y-%m")
-                    if monthly_traffic_state.get("month") != current_month:
+            bytes_sent, bytes_recv = read_interface_counters(proc_file)
+            bytes_sent_delta = counter_delta(bytes_sent, last_bytes_sent)
+            bytes_recv_delta = counter_delta(bytes_recv, last_bytes_recv)
+            if time_delta_ns > 0:
+                # bits / (ns / 1e9) / 1e6 == bits * 1e3 / ns, kept in integers
+                # until the single final division.
+                speed_sent_mbps = bytes_sent_delta * 8_000 / time_delta_ns
+                speed_recv_mbps = bytes_recv_delta * 8_000 / time_delta_ns
+                # Once the ring is full, the slot being overwritten holds
+                # the oldest sample, which drops out of the running total.
+                is_full = sample_count == MAX_SAMPLES
+                row = speed_ring[write_idx]
+                old_sent, old_recv = row.tolist() if is_full else (0.0, 0.0)
+                row[0] = speed_sent_mbps
+                row[1] = speed_recv_mbps
+                running_total_sent += speed_sent_mbps - old_sent
+                running_total_recv += speed_recv_mbps - old_recv
+                write_idx = (write_idx + 1) % MAX_SAMPLES
+                sample_count = min(sample_count + 1, MAX_SAMPLES)
+
+                # The month key only changes once next_month_epoch is passed,
+                # so skip building a datetime on every other tick.
+                current_month, month_sent, month_recv = monthly_traffic_state
+                if time.time() >= next_month_epoch:
+                    next_month_epoch = compute_next_month_epoch()
+                    new_month = datetime.now().strftime("%Y-%m")
+                    if new_month != current_month:
                         logging.info(
-                            f"🎉 Month rolled over to {current_month}. Resetting monthly traffic."
+                            f"🎉 Month rolled over to {new_month}. Resetting monthly traffic."
                         )
-                        monthly_traffic_state = {
-                            "month": current_month,
-                            "total_bytes_sent": 0,
-                            "total_bytes_recv": 0,
-                        }
-                    monthly_traffic_state["total_bytes_sent"] += bytes_sent_delta
-                    monthly_traffic_state["total_bytes_recv"] += bytes_recv_delta
-
-            last_bytes_sent = net_io.bytes_sent
-            last_bytes_recv = net_io.bytes_recv
-            last_check_time = current_time
+                        current_month = new_month
+                        month_sent, month_recv = 0, 0
+                # Publish fresh objects rather than mutating in place so the
+                # endpoints can read them without a lock: rebinding a global
+                # name is atomic under the GIL.
+                monthly_traffic_state = (
+                    current_month,
+                    month_sent + bytes_sent_delta,
+                    month_recv + bytes_recv_delta,
+                )
+                cached_stats_body = render_bandwidth_stats(
+                    running_total_sent, running_total_recv, sample_count
+                )
+
+            last_bytes_sent = bytes_sent
+            last_bytes_recv = bytes_recv
+            last_check_ns = current_ns
         except Exception as e:
             logging.error(f"Error during network stats collection: {e}")
 
+    if proc_file is not None:
+        proc_file.close()
+
+
+# FastAPI Lifecycle
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    logging.info("🚀 Server starting up...")
+    load_monthly_traffic()
+    # A fresh Event per lifespan, so restarting the app in the same process
+    # doesn't start a sampler that sees the previous run's shutdown signal.
+    shutdown = threading.Event()
+    sampler = threading.Thread(
+        target=monitor_bandwidth,
+        args=(shutdown,),
+        name="bandwidth-sampler",
+        daemon=True,
+    )
+    sampler.start()
+    async with asyncio.TaskGroup() as tg:
+        saver = tg.create_task(save_monthly_traffic_periodically())
+        yield
+        saver.cancel()
+
+    logging.info("🛑 Server shutting down...")
+    shutdown.set()
+    await asyncio.to_thread(sampler.join, SAMPLE_INTERVAL_SECONDS)
+    # Flush whatever was counted since the last periodic save.
+    await save_monthly_traffic()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
 
 # API Endpoints
 @app.get("/api/v1/stats/bandwidth", dependencies=[Depends(get_api_key)])
-def get_bandwidth_stats():
-    with GLOBAL_LOCK:
-        if not sent_samples:
-            avg_sent, avg_recv, current_count = 0.0, 0.0, 0
-        else:
-            current_count = len(sent_samples)
-            avg_sent = running_total_sent / current_count
-            avg_recv = running_total_recv / current_count
-    return {
-        "network_interface": NETWORK_INTERFACE,
-        "average_speed_mbps": {
-            "sent": round(avg_sent, 2),
-            "received": round(avg_recv, 2),
-            "total": round(avg_sent + avg_recv, 2),
-        },
-        "period_seconds": MAX_SAMPLES * SAMPLE_INTERVAL_SECONDS,
-        "current_sample_count": current_count,
-        "max_samples_for_avg": MAX_SAMPLES,
-    }
+async def get_bandwidth_stats():
+    return Response(content=cached_stats_body, media_type="application/json")
 
 
 @app.get("/api/v1/stats/monthly-traffic", dependencies=[Depends(get_api_key)])
-def get_monthly_traffic():
-    with GLOBAL_LOCK:
-        state = monthly_traffic_state.copy()
-    total_bytes = state.get("total_bytes_sent", 0) + state.get("total_bytes_recv", 0)
-    return {
-        "month": state.get("month"),
+async def get_monthly_traffic():
+    month, sent, recv = monthly_traffic_state
+    total_bytes = sent + recv
+    body = {
+        "month": month,
         "data_usage": {
-            "sent": format_bytes(state.get("total_bytes_sent", 0)),
-            "received": format_bytes(state.get("total_bytes_recv", 0)),
+            "sent": format_bytes(sent),
+            "received": format_bytes(recv),
             "total": format_bytes(total_bytes),
         },
         "raw_bytes": {
-            "sent": state.get("total_bytes_sent", 0),
-            "received": state.get("total_bytes_recv", 0),
+            "sent": sent,
+            "received": recv,
             "total": total_bytes,
         },
     }
-
-
-# FastAPI Lifecycle
-@app.on_event("startup")
-async def startup_event():
-    logging.info("🚀 Server starting up...")
-    load_monthly_traffic()
-    asyncio.create_task(monitor_bandwidth())
-    asyncio.create_task(save_monthly_traffic_periodically())
+    return Response(content=orjson.dumps(body), media_type="application/json")
 
 
 if __name__ == "__main__":